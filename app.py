@@ -1,33 +1,57 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
+from functools import lru_cache
 import redis
-import json
+import orjson
+import ijson
+import hashlib
+import mmap
+import multiprocessing
 import sys
 import os
+import threading
 import time
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes as it was causing the external websites to not connect
 
+def ojsonify(obj):
+    """jsonify() replacement backed by orjson for the hot endpoints"""
+    return Response(orjson.dumps(obj), mimetype='application/json')
+
 # Redis connection with environment variables for Docker
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
 REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
+# Set when Redis runs on the same host to skip TCP (e.g. /var/run/redis/redis.sock)
+REDIS_SOCKET = os.getenv('REDIS_SOCKET')
 
 # Retry logic for Redis connection (important for Docker startup)
-def get_redis_client():
+def connect_redis():
     max_retries = 5
+    if REDIS_SOCKET:
+        address = {'connection_class': redis.UnixDomainSocketConnection, 'path': REDIS_SOCKET}
+        location = REDIS_SOCKET
+    else:
+        address = {'host': REDIS_HOST, 'port': REDIS_PORT}
+        location = f"{REDIS_HOST}:{REDIS_PORT}"
+    
+    # One pool per process shared by every request thread. When all
+    # connections are busy a thread waits up to `timeout` seconds for one
+    # instead of failing with "Too many connections"
+    pool = redis.BlockingConnectionPool(
+        **address,
+        db=0,
+        decode_responses=False,  # city blobs are served as raw JSON bytes
+        max_connections=200,
+        timeout=1,
+        socket_connect_timeout=5
+    )
+    
     for i in range(max_retries):
         try:
-            client = redis.Redis(
-                host=REDIS_HOST,
-                port=REDIS_PORT,
-                db=0,
-                decode_responses=True,
-                max_connections=50,
-                socket_connect_timeout=5
-            )
+            client = redis.Redis(connection_pool=pool)
             client.ping()
-            print(f"✅ Connected to Redis at {REDIS_HOST}:{REDIS_PORT}")
+            print(f"✅ Connected to Redis at {location}")
             return client
         except redis.ConnectionError as e:
             if i < max_retries - 1:
@@ -37,76 +61,291 @@ def get_redis_client():
                 print(f"❌ Failed to connect to Redis: {e}")
                 raise
 
-redis_client = get_redis_client()
+# Created on first use rather than at import so each gunicorn worker opens its
+# own pool after forking (and importing the app never blocks on Redis)
+_redis_client = None
+_redis_client_lock = threading.Lock()
+
+def get_redis_client():
+    """Return this process's shared Redis client, connecting on first use"""
+    global _redis_client
+    if _redis_client is None:
+        with _redis_client_lock:
+            if _redis_client is None:
+                _redis_client = connect_redis()
+    return _redis_client
 
 # Redis key prefixes
 CITY_PREFIX = "city:"
-NAME_INDEX_PREFIX = "name:"
-SEARCH_PREFIX = "search:"
 
-def load_cities_to_redis(json_file='cities.json'):
-    """Load cities from JSON/JSONL into Redis with multiple indexes"""
-    print("Loading cities into Redis...")
+# Single sorted set used as the prefix index: every member has score 0 and is
+# stored as "<lowercase name>\x00<city id>\x00<display name>" so ZRANGEBYLEX can
+# serve prefixes (an exact name is just the range [name\x00 .. (name\x01) and
+# autocomplete never has to fetch or decode the city itself
+AUTOCOMPLETE_KEY = "cities:autocomplete"
+# The loader fills this key and RENAMEs it over AUTOCOMPLETE_KEY when done, so
+# a reload never leaves members from an older format or dataset behind
+AUTOCOMPLETE_BUILD_KEY = "cities:autocomplete:build"
+
+# Indexes written by earlier versions of the loader; cleared on every load
+LEGACY_KEY_PATTERNS = ("search:*", "name:*")
+
+# Rendered autocomplete suggestions, keyed by "<query>:<limit>"
+AUTOCOMPLETE_CACHE_PREFIX = "ac:resp:"
+AUTOCOMPLETE_CACHE_TTL = 600  # seconds
+AUTOCOMPLETE_CACHE_MAX_QUERY_LENGTH = 20
+
+# Shorter queries match a large slice of the dataset and are rejected
+MIN_PREFIX_LENGTH = int(os.getenv('MIN_PREFIX_LENGTH', 2))
+
+# Prefixes up to this many characters match the most cities, so the loader
+# stores their suggestions up front (without a TTL) for these limits
+AUTOCOMPLETE_PRECOMPUTE_LENGTH = 3
+AUTOCOMPLETE_PRECOMPUTE_LIMITS = (10, 25, 50)
+
+def prefix_range(query_lower):
+    """Return the (min, max) ZRANGEBYLEX bounds matching every name with this prefix"""
+    prefix = query_lower.encode('utf-8')
+    return b'[' + prefix, b'[' + prefix + b'\xff'
+
+def find_city_names(query_lower, limit):
+    """Look up up to `limit` display names of cities whose name starts with `query_lower`"""
+    # A negative LIMIT count makes Redis return the whole range
+    if limit <= 0:
+        return []
+    low, high = prefix_range(query_lower)
+    members = get_redis_client().zrangebylex(AUTOCOMPLETE_KEY, low, high, start=0, num=limit)
+    return [member.split(b'\x00', 2)[2].decode() for member in members]
+
+def render_suggestions(query_lower, limit):
+    """Build the JSON array of city names matching a prefix"""
+    return orjson.dumps(find_city_names(query_lower, limit))
+
+# Resolves a prefix to city blobs server-side so /search takes one round-trip.
+# KEYS[1] = prefix index, ARGV = min, max, limit, city key prefix
+SEARCH_SCRIPT = """
+local members = redis.call('ZRANGEBYLEX', KEYS[1], ARGV[1], ARGV[2], 'LIMIT', 0, ARGV[3])
+if #members == 0 then
+    return {}
+end
+local city_keys = {}
+for i, member in ipairs(members) do
+    local id_start = string.find(member, '\\0', 1, true) + 1
+    local id_end = string.find(member, '\\0', id_start, true) - 1
+    city_keys[i] = ARGV[4] .. string.sub(member, id_start, id_end)
+end
+return redis.call('MGET', unpack(city_keys))
+"""
+SEARCH_SCRIPT_SHA = hashlib.sha1(SEARCH_SCRIPT.encode()).hexdigest()
+
+def run_search_script(query_lower, limit):
+    """Return the city blobs for a prefix via EVALSHA, loading the script on NOSCRIPT"""
+    if limit <= 0:
+        return []
+    low, high = prefix_range(query_lower)
+    args = (AUTOCOMPLETE_KEY, low, high, limit, CITY_PREFIX)
+    client = get_redis_client()
+    try:
+        return client.evalsha(SEARCH_SCRIPT_SHA, 1, *args)
+    except redis.exceptions.NoScriptError:
+        return client.eval(SEARCH_SCRIPT, 1, *args)
+
+def is_json_array(json_file):
+    """Peek at the first non-blank byte to tell a JSON array from JSONL"""
+    with open(json_file, 'rb') as f:
+        first = f.read(1)
+        while first and first.isspace():
+            first = f.read(1)
+    return first == b'['
+
+def iter_jsonl(data, start, end):
+    """Yield cities from the JSONL lines in data[start:end]"""
+    pos = start
+    while pos < end:
+        newline = data.find(b'\n', pos, end)
+        if newline == -1:
+            newline = end
+        line = data[pos:newline].strip()
+        if line:
+            try:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError as e:
+                print(f"⚠️  Skipping invalid JSON at byte {pos}: {e}")
+        pos = newline + 1
+
+def jsonl_shards(data, count):
+    """Split data into up to `count` (start, end) ranges on line boundaries"""
+    shards = []
+    start = 0
+    for i in range(1, count + 1):
+        if start >= len(data):
+            break
+        end = len(data)
+        if i < count:
+            newline = data.find(b'\n', max(start, len(data) * i // count))
+            if newline != -1:
+                end = newline + 1
+        shards.append((start, end))
+        start = end
+    return shards
+
+def write_city_batch(batch):
+    """Write one batch of cities and their indexes in a single pipeline"""
+    # Non-transactional pipeline: bulk loading only needs fewer round-trips,
+    # not MULTI/EXEC atomicity
+    pipe = get_redis_client().pipeline(transaction=False)
+    autocomplete_members = {}
     
-    cities = []
-    with open(json_file, 'r') as f:
-        # Try to load as JSON array first
-        try:
-            f.seek(0)
-            cities = json.load(f)
-            print("Loaded as JSON array")
-        except json.JSONDecodeError:
-            # If that fails, treat as JSONL (one JSON object per line)
-            print("Loading as JSONL format (one object per line)...")
-            f.seek(0)
-            for line_num, line in enumerate(f, 1):
-                line = line.strip()
-                if line:
-                    try:
-                        cities.append(json.loads(line))
-                    except json.JSONDecodeError as e:
-                        print(f"⚠️  Skipping invalid JSON on line {line_num}: {e}")
-                        continue
-    
-    pipe = redis_client.pipeline()
-    batch_size = 1000
-    
-    for idx, city in enumerate(cities):
+    for city in batch:
         city_id = city['id']
         name_lower = city['name'].lower()
         
         # Store full city data by ID
-        pipe.set(f"{CITY_PREFIX}{city_id}", json.dumps(city))
-        
-        # Index by exact name (lowercase)
-        pipe.sadd(f"{NAME_INDEX_PREFIX}{name_lower}", city_id)
+        pipe.set(f"{CITY_PREFIX}{city_id}", orjson.dumps(city))
         
-        # Create prefix indexes for fast autocomplete (1-char to full name)
-        for i in range(1, len(name_lower) + 1):
-            prefix = name_lower[:i]
-            pipe.sadd(f"{SEARCH_PREFIX}{prefix}", city_id)
+        autocomplete_members[f"{name_lower}\x00{city_id}\x00{city['name']}"] = 0
+    
+    # Add the whole batch to the lexicographic prefix index in one ZADD
+    if autocomplete_members:
+        pipe.zadd(AUTOCOMPLETE_BUILD_KEY, autocomplete_members)
+    
+    pipe.execute()
+
+def load_city_stream(cities):
+    """Write an iterable of cities to Redis in batches, returning how many were loaded"""
+    batch_size = 10000
+    batch = []
+    loaded = 0
+    
+    for city in cities:
+        batch.append(city)
+        loaded += 1
         
         # Execute in batches to avoid memory issues
-        if (idx + 1) % batch_size == 0:
-            pipe.execute()
-            pipe = redis_client.pipeline()
-            print(f"Processed {idx + 1}/{len(cities)} cities...")
+        if len(batch) == batch_size:
+            write_city_batch(batch)
+            batch = []
+            print(f"Processed {loaded} cities...")
     
     # Execute remaining commands
+    write_city_batch(batch)
+    return loaded
+
+def load_jsonl_shard(json_file, start, end):
+    """Pool worker: load one byte range of a JSONL file over its own connection"""
+    with open(json_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return load_city_stream(iter_jsonl(data, start, end))
+
+def delete_keys(pattern):
+    """UNLINK every key matching a glob pattern, returning how many were removed"""
+    client = get_redis_client()
+    pipe = client.pipeline(transaction=False)
+    deleted = 0
+    
+    for key in client.scan_iter(match=pattern, count=1000):
+        pipe.unlink(key)
+        deleted += 1
+        if len(pipe) >= 10000:
+            pipe.execute()
+    
     pipe.execute()
-    print(f"✅ Loaded {len(cities)} cities into Redis")
-    print(f"Total keys: {redis_client.dbsize()}")
+    return deleted
+
+def precompute_suggestions():
+    """Fill the autocomplete cache for every short prefix present in the index"""
+    client = get_redis_client()
+    pipe = client.pipeline(transaction=False)
+    max_limit = max(AUTOCOMPLETE_PRECOMPUTE_LIMITS)
+    prefixes = 0
+    
+    for length in range(MIN_PREFIX_LENGTH, AUTOCOMPLETE_PRECOMPUTE_LENGTH + 1):
+        # Walk the index in lex order, jumping past each prefix once it is done
+        cursor = b'-'
+        while True:
+            members = client.zrangebylex(AUTOCOMPLETE_KEY, cursor, b'+', start=0, num=1)
+            if not members:
+                break
+            name_lower = members[0].split(b'\x00', 1)[0].decode()
+            if len(name_lower) < length:
+                cursor = b'(' + members[0]
+                continue
+            
+            prefix = name_lower[:length]
+            names = find_city_names(prefix, max_limit)
+            for limit in AUTOCOMPLETE_PRECOMPUTE_LIMITS:
+                pipe.set(f"{AUTOCOMPLETE_CACHE_PREFIX}{prefix}:{limit}", orjson.dumps(names[:limit]))
+            prefixes += 1
+            cursor = b'(' + prefix.encode('utf-8') + b'\xff'
+            
+            if len(pipe) >= 10000:
+                pipe.execute()
+    
+    pipe.execute()
+    return prefixes
+
+def load_cities_to_redis(json_file='cities.json'):
+    """Load cities from JSON/JSONL into Redis with multiple indexes"""
+    print("Loading cities into Redis...")
+    client = get_redis_client()
+    
+    # Start from an empty build index (a previous load may have been cut short)
+    client.delete(AUTOCOMPLETE_BUILD_KEY)
+    for pattern in LEGACY_KEY_PATTERNS:
+        print(f"Removed {delete_keys(pattern)} legacy {pattern} keys")
+    
+    if is_json_array(json_file):
+        # A JSON array can only be parsed front to back, so stream it here
+        print("Streaming JSON array")
+        with open(json_file, 'rb') as f:
+            loaded = load_city_stream(ijson.items(f, 'item', use_float=True))
+    elif os.path.getsize(json_file) == 0:
+        loaded = 0
+    else:
+        # JSONL splits cleanly on newlines: parse and write shards in parallel
+        with open(json_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            shards = jsonl_shards(data, os.cpu_count() or 1)
+        print(f"Loading as JSONL format (one object per line) in {len(shards)} processes...")
+        with multiprocessing.Pool(len(shards)) as pool:
+            loaded = sum(pool.starmap(load_jsonl_shard, [(json_file, *shard) for shard in shards]))
+    
+    # Swap the freshly built index in; an empty load leaves no index at all
+    if client.exists(AUTOCOMPLETE_BUILD_KEY):
+        client.rename(AUTOCOMPLETE_BUILD_KEY, AUTOCOMPLETE_KEY)
+    else:
+        client.delete(AUTOCOMPLETE_KEY)
+    
+    print(f"✅ Loaded {loaded} cities into Redis")
+    
+    # Cached suggestions describe the previous dataset; precomputed ones have
+    # no TTL and would otherwise be served forever
+    print(f"Removed {delete_keys(f'{AUTOCOMPLETE_CACHE_PREFIX}*')} cached autocomplete responses")
+    print(f"Precomputed autocomplete for {precompute_suggestions()} prefixes")
+    print(f"Total keys: {client.dbsize()}")
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100  # caps the MGET fan-out of a single request
+
+def _parse_limit():
+    """Read ?limit=, falling back to the default on garbage or non-positive values and capping it"""
+    try:
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        return DEFAULT_LIMIT
+    if limit <= 0:
+        return DEFAULT_LIMIT
+    return min(limit, MAX_LIMIT)
 
 @app.route('/health')
 def health():
     """Health check endpoint"""
     try:
-        redis_client.ping()
+        client = get_redis_client()
+        client.ping()
         return jsonify({
             'status': 'ok',
             'redis': 'connected',
             'redis_host': REDIS_HOST,
-            'total_keys': redis_client.dbsize()
+            'total_keys': client.dbsize()
         })
     except Exception as e:
         return jsonify({
@@ -122,36 +361,48 @@ def search():
     Usage: /search?q=shang&limit=10
     """
     query = request.args.get('q', '').strip()
-    limit = int(request.args.get('limit', 10))
+    limit = _parse_limit()
     
     if not query:
-        return jsonify({'error': 'Query parameter "q" required'}), 400
+        return ojsonify({'error': 'Query parameter "q" required'}), 400
     
     query_lower = query.lower()
+    if len(query_lower) < MIN_PREFIX_LENGTH:
+        return ojsonify({'error': f'Query must be at least {MIN_PREFIX_LENGTH} characters'}), 400
     
-    # Get city IDs from prefix index
-    city_ids = redis_client.smembers(f"{SEARCH_PREFIX}{query_lower}")
+    # Prefix lookup and city fetch happen in a single Lua call
+    cities_data = [city for city in run_search_script(query_lower, limit) if city]
     
-    if not city_ids:
-        return jsonify({
-            'query': query,
-            'count': 0,
-            'results': []
-        })
-    
-    # Fetch city data (use pipeline for batch fetch)
-    pipe = redis_client.pipeline()
-    for city_id in list(city_ids)[:limit]:
-        pipe.get(f"{CITY_PREFIX}{city_id}")
-    
-    cities_data = pipe.execute()
-    results = [json.loads(city) for city in cities_data if city]
+    # City blobs are already compact JSON, so splice them into the response
+    # body instead of parsing and re-serializing every result
+    body = b'{"query":%s,"count":%d,"results":[%s]}' % (
+        orjson.dumps(query), len(cities_data), b','.join(cities_data)
+    )
+    return Response(body, mimetype='application/json')
+
+# City data is static once loaded, so each worker keeps the hottest blobs in
+# memory (restart workers after a reload). Misses raise instead of returning
+# None because lru_cache does not cache exceptions: a city requested before the
+# loader finished is looked up again next time.
+@lru_cache(maxsize=10000)
+def _get_city_bytes(city_id):
+    city = get_redis_client().get(f"{CITY_PREFIX}{city_id}")
+    if city is None:
+        raise KeyError(city_id)
+    return city
+
+@app.route('/city/<int:city_id>')
+def get_city(city_id):
+    """
+    Get a single city by ID
+    Usage: /city/1796236
+    """
+    try:
+        city = _get_city_bytes(city_id)
+    except KeyError:
+        return ojsonify({'error': 'City not found'}), 404
     
-    return jsonify({
-        'query': query,
-        'count': len(results),
-        'results': results
-    })
+    return Response(city, mimetype='application/json')
 
 @app.route('/autocomplete')
 def autocomplete():
@@ -160,26 +411,30 @@ def autocomplete():
     Usage: /autocomplete?q=sh&limit=10
     """
     query = request.args.get('q', '').strip()
-    limit = int(request.args.get('limit', 10))
+    limit = _parse_limit()
     
     if not query:
-        return jsonify({'error': 'Query parameter "q" required'}), 400
+        return ojsonify({'error': 'Query parameter "q" required'}), 400
     
     query_lower = query.lower()
-    city_ids = redis_client.smembers(f"{SEARCH_PREFIX}{query_lower}")
+    if len(query_lower) < MIN_PREFIX_LENGTH:
+        return ojsonify({'error': f'Query must be at least {MIN_PREFIX_LENGTH} characters'}), 400
     
-    # Fetch only names (faster than full objects)
-    pipe = redis_client.pipeline()
-    for city_id in list(city_ids)[:limit]:
-        pipe.get(f"{CITY_PREFIX}{city_id}")
+    cache_key = f"{AUTOCOMPLETE_CACHE_PREFIX}{query_lower}:{limit}"
     
-    cities_data = pipe.execute()
-    suggestions = [json.loads(city)['name'] for city in cities_data if city]
+    # Popular prefixes are served straight from the cached suggestions array
+    client = get_redis_client()
+    cacheable = len(query_lower) <= AUTOCOMPLETE_CACHE_MAX_QUERY_LENGTH
+    suggestions = client.get(cache_key) if cacheable else None
+    if suggestions is None:
+        suggestions = render_suggestions(query_lower, limit)
+        # Empty results and long queries are never cached, so junk input
+        # cannot flood the keyspace with one-off entries
+        if cacheable and suggestions != b'[]':
+            client.setex(cache_key, AUTOCOMPLETE_CACHE_TTL, suggestions)
     
-    return jsonify({
-        'query': query,
-        'suggestions': suggestions
-    })
+    body = b'{"query":%s,"suggestions":%s}' % (orjson.dumps(query), suggestions)
+    return Response(body, mimetype='application/json')
 
 @app.route('/')
 def index():
@@ -195,8 +450,10 @@ def index():
         }
     })
 
+# python -m app load [cities.json]  -> populate Redis
+# python -m app                    -> development server
 if __name__ == '__main__':
     if len(sys.argv) > 1 and sys.argv[1] == 'load':
-        load_cities_to_redis()
+        load_cities_to_redis(*sys.argv[2:3])
     else:
-        app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+        app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,15 @@
+# gunicorn.conf.py
+import multiprocessing
+import os
+
+bind = "0.0.0.0:5000"
+timeout = 120
+
+# Requests spend nearly all their time waiting on Redis, so each worker runs
+# many threads to keep lots of Redis calls in flight at once. The threads
+# provide the concurrency; one worker per CPU is enough (each holds its own
+# Redis pool and city cache). cpu_count() ignores container CPU limits, so set
+# WEB_WORKERS explicitly when running under one.
+worker_class = "gthread"
+workers = int(os.getenv('WEB_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.getenv('WEB_THREADS', 32))